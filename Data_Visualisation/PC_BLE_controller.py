@@ -4,11 +4,173 @@ from tkinter import filedialog, scrolledtext
 from bleak import BleakClient
 import os
 import datetime
+import queue
+import threading
+import time
+from array import array
 from collections import deque
 
 # UUID for BLE characteristic (same as your Arduino)
 CHARACTERISTIC_UUID = "87654321-4321-4321-4321-ba0987654321"
 
+# INA228 CSV stream columns, in the order the logger sends them
+INA228_COLUMNS = ("bus_voltage", "current_mA", "power")
+
+# Replies the logger firmware sends on the same characteristic as CSV data
+DEVICE_ACKS = {b"pong", b"Sample rate updated.", b"Duration updated.", b"Time updated."}
+
+
+class INA228CSVStream:
+    """Receives one start_csv session and writes it to rotating CSV files.
+
+    Notifications are reassembled into lines, parsed into typed arrays and
+    handed to a writer thread in fixed-size chunks. feed() runs on the BLE
+    event loop and never blocks: if the disk falls behind, chunks queue up in
+    memory and a warning is logged past the high-water mark. GATT
+    notifications have no flow control, so throttling the device itself
+    would need firmware support (indications or credits).
+    """
+
+    def __init__(self, save_dir, sample_rate, duration, log,
+                 chunk_rows=1024, high_water_chunks=64, rows_per_file=1_000_000):
+        self.expected = sample_rate * duration
+        self.log = log
+        self.chunk_rows = chunk_rows
+        self.rows_per_file = rows_per_file
+        stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        self.base_path = os.path.join(save_dir, f"ina228_{stamp}")
+
+        self.pending = bytearray()  # partial line carried between notifications
+        self.columns = self._new_columns()
+        self.received = 0
+        self.rows_written = 0
+        self.files_written = 0
+        self.write_error = None
+        self.finished = False
+        self.last_rx = time.monotonic()
+
+        self.high_water_chunks = high_water_chunks
+        self.over_high_water = False
+        self.chunks = queue.Queue()
+        self.done = threading.Event()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    @staticmethod
+    def _new_columns():
+        return tuple(array('d') for _ in INA228_COLUMNS)
+
+    @property
+    def complete(self):
+        return self.finished or self.received >= self.expected
+
+    def feed(self, data):
+        if self.finished:
+            return
+        self.last_rx = time.monotonic()
+
+        # Command acknowledgements ("Duration updated.") share the characteristic
+        if not self.pending and data.strip() in DEVICE_ACKS:
+            self.log(f"ℹ️ Device: {data.decode(errors='replace').strip()}")
+            return
+
+        self.pending += data
+        end = self.pending.rfind(b"\n")
+        if end < 0:
+            return
+        lines = self.pending[:end].split(b"\n")
+        del self.pending[:end + 1]
+
+        for line in lines:
+            self._parse_line(line)
+        if self.received >= self.expected:
+            self.finish()
+
+    def _parse_line(self, line):
+        if self.received >= self.expected:
+            return
+        fields = line.strip().split(b",")
+        if len(fields) != len(INA228_COLUMNS):
+            if line.strip():
+                self.log(f"⚠️ Skipping malformed row: {line.decode(errors='replace')}")
+            return
+        try:
+            values = [float(f) for f in fields]
+        except ValueError:
+            self.log(f"⚠️ Skipping malformed row: {line.decode(errors='replace')}")
+            return
+
+        for column, value in zip(self.columns, values):
+            column.append(value)
+        self.received += 1
+        if len(self.columns[0]) >= self.chunk_rows:
+            self._hand_off()
+
+    def _hand_off(self):
+        if len(self.columns[0]):
+            self.chunks.put_nowait(self.columns)
+            self.columns = self._new_columns()
+
+            backlog = self.chunks.qsize()
+            if backlog > self.high_water_chunks and not self.over_high_water:
+                self.log(f"⚠️ CSV writer falling behind: {backlog} chunks buffered in memory.")
+                self.over_high_water = True
+            elif backlog <= self.high_water_chunks // 2:
+                self.over_high_water = False
+
+    def finish(self):
+        if self.finished:
+            return
+        if self.pending and self.received < self.expected:
+            self._parse_line(bytes(self.pending))
+            self.pending.clear()
+        self._hand_off()
+        self.finished = True
+        self.chunks.put(None)
+
+    def _open_part(self, part):
+        f = open(f"{self.base_path}_{part:03d}.csv", "x", newline="")
+        f.write(",".join(INA228_COLUMNS) + "\n")
+        return f
+
+    def _write_loop(self):
+        f = None
+        rows_in_file = 0
+        try:
+            while True:
+                chunk = self.chunks.get()
+                if chunk is None:
+                    break
+                if self.write_error:
+                    continue  # drain the queue so the session can finish
+                try:
+                    voltage, current, power = chunk
+                    i, n = 0, len(voltage)
+                    while i < n:
+                        if f is None or rows_in_file >= self.rows_per_file:
+                            if f:
+                                f.close()
+                            f = self._open_part(self.files_written)
+                            self.files_written += 1
+                            rows_in_file = 0
+                        j = min(n, i + self.rows_per_file - rows_in_file)
+                        f.write("".join(
+                            f"{voltage[k]:.8f},{current[k]:.8f},{power[k]:.8f}\n"
+                            for k in range(i, j)
+                        ))
+                        rows_in_file += j - i
+                        self.rows_written += j - i
+                        i = j
+                    f.flush()
+                except OSError as e:
+                    self.log(f"⚠️ CSV write error: {e}")
+                    self.write_error = e
+        finally:
+            if f:
+                f.close()
+            self.done.set()
+
+
 class BLEApp:
     def __init__(self, master):
         self.master = master
@@ -25,6 +187,10 @@ class BLEApp:
 
         # BLE client handle
         self.client = None
+        self.notifying = False
+
+        # Active start_csv receiver, if any
+        self.csv_stream = None
 
         # --- GUI Setup ---
 
@@ -86,7 +252,6 @@ class BLEApp:
         self.log_text.pack(padx=10, pady=(0,10), fill='both', expand=True)
 
         # Start asyncio event loop on background thread
-        import threading
         threading.Thread(target=self.start_loop, daemon=True).start()
 
         # Periodically update log text widget from FIFO buffer
@@ -133,6 +298,7 @@ class BLEApp:
                 self.log_message("ℹ️ Disconnected previous connection.")
 
             self.client = BleakClient(address)
+            self.notifying = False
             await self.client.connect()
             if self.client.is_connected:
                 self.log_message(f"✅ Connected to {address}!")
@@ -157,13 +323,60 @@ class BLEApp:
         except ValueError:
             self.log_message("⚠️ Invalid sample rate or duration. Please enter integers.")
             return
+        if sample_rate <= 0 or duration <= 0:
+            self.log_message("⚠️ Sample rate and duration must be greater than zero.")
+            return
 
         save_path = self.save_location.get()
         self.log_message(f"📈 Starting CSV stream at {sample_rate} Hz for {duration}s, saving to {save_path}...")
-        # Send sample rate and duration commands separately or combined
-        self.loop.call_soon_threadsafe(asyncio.create_task, self.send_command(f"set_sample_rate,{sample_rate}"))
-        self.loop.call_soon_threadsafe(asyncio.create_task, self.send_command(f"set_duration,{duration}"))
-        self.loop.call_soon_threadsafe(asyncio.create_task, self.send_command("start_csv"))
+        self.loop.call_soon_threadsafe(asyncio.create_task, self.run_csv_session(sample_rate, duration, save_path))
+
+    async def run_csv_session(self, sample_rate, duration, save_path, idle_timeout=5.0):
+        if not (self.client and self.client.is_connected):
+            self.log_message("⚠️ Not connected to any BLE device.")
+            return
+        if self.csv_stream:
+            self.csv_stream.finish()
+
+        stream = INA228CSVStream(save_path, sample_rate, duration, self.log_message)
+        self.csv_stream = stream
+        try:
+            if not self.notifying:
+                await self.client.start_notify(CHARACTERISTIC_UUID, self.handle_notification)
+                self.notifying = True
+
+            # Sent in order from one task so the device sees its settings before start_csv
+            await self.send_command(f"set_sample_rate,{sample_rate}")
+            await self.send_command(f"set_duration,{duration}")
+            await self.send_command("start_csv")
+
+            started = time.monotonic()
+            while not stream.complete:
+                await asyncio.sleep(0.2)
+                now = time.monotonic()
+                if now - started > duration and now - stream.last_rx > idle_timeout:
+                    self.log_message("⚠️ CSV stream went idle before all samples arrived.")
+                    break
+        except Exception as e:
+            self.log_message(f"⚠️ CSV stream error: {e}")
+        finally:
+            stream.finish()
+            if self.csv_stream is stream:
+                self.csv_stream = None
+            await self.loop.run_in_executor(None, stream.done.wait)
+
+        if stream.write_error:
+            self.log_message(f"❌ CSV save failed ({stream.write_error}): wrote {stream.rows_written} of "
+                             f"{stream.received} received samples to {stream.files_written} file(s).")
+        else:
+            self.log_message(f"💾 Saved {stream.rows_written}/{stream.expected} samples to "
+                             f"{stream.files_written} file(s) at {stream.base_path}_*.csv")
+
+    def handle_notification(self, sender, data):
+        if self.csv_stream:
+            self.csv_stream.feed(data)
+        else:
+            self.log_message(f"⬅️ Received: {data.decode(errors='replace').strip()}")
 
     def ping_device(self):
         self.log_message("📡 Sending ping...")
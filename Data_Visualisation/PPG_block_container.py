@@ -0,0 +1,407 @@
+import os
+import struct
+import zlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+# Block-indexed container for compressed PPG recordings.
+#
+# Layout (all little-endian):
+#   file header   magic "PPGC", version, codec, sample rate (Hz), rows per block
+#   blocks        block header + payload, each block decodable on its own
+#   offset table  one entry per block: file offset, first sample, sample count
+#   trailer       offset of the table, block count, CRC32 of the table, magic "PPGI"
+#
+# Appends only ever write past the existing blocks. A partial last block is
+# rewritten as a new block further on, and the old copy becomes dead space once
+# the new offset table is written. New blocks are synced to disk before the
+# table; a table that fails its CRC or disagrees with the block headers is
+# ignored and rebuilt by scanning the blocks.
+#
+# Block payloads use the same byte layout as the firmware compressors (minus the
+# leading algorithm ID byte, which lives in the block header), so a block is what
+# compressRLE / compressHuffman would produce for that slice of the CSV.
+
+FILE_MAGIC = b"PPGC"
+BLOCK_MAGIC = b"PBLK"
+INDEX_MAGIC = b"PPGI"
+VERSION = 1
+
+FILE_HEADER = struct.Struct("<4sHBxdI")     # magic, version, codec, sample_rate, block_rows
+BLOCK_HEADER = struct.Struct("<4sB3xQIIII")  # magic, codec, first_sample, sample_count, raw_len, payload_len, crc32
+INDEX_ENTRY = struct.Struct("<QQI")          # offset, first_sample, sample_count
+TRAILER = struct.Struct("<QII4s")            # index_offset, block_count, table_crc32, magic
+
+# Algorithm IDs match the firmware (0x01 autoencoder and 0x02 PCA are lossy and not stored here)
+CODECS = {"RAW": 0x00, "RLE": 0x03, "HUFFMAN": 0x04}
+CODEC_NAMES = {v: k for k, v in CODECS.items()}
+
+
+# --- Codecs ---
+
+def encode_rle(data):
+    out = bytearray()
+    i, n = 0, len(data)
+    while i < n:
+        value = data[i]
+        count = 1
+        while i + count < n and data[i + count] == value and count < 255:
+            count += 1
+        out += bytes((value, count))
+        i += count
+    return bytes(out)
+
+
+def decode_rle(payload):
+    out = bytearray()
+    for i in range(0, len(payload) - 1, 2):
+        out += bytes((payload[i],)) * payload[i + 1]
+    return bytes(out)
+
+
+def _huffman_tree(freq):
+    # Same merge order as compressHuffman so codes match the firmware bit for bit.
+    # Leaves are ints (symbols), internal nodes are (left, right) tuples.
+    nodes = [(freq[s], s) for s in range(256) if freq[s] > 0]
+    while len(nodes) > 1:
+        min1, min2 = 0, 1
+        if nodes[min2][0] < nodes[min1][0]:
+            min1, min2 = min2, min1
+        for i in range(2, len(nodes)):
+            if nodes[i][0] < nodes[min1][0]:
+                min2 = min1
+                min1 = i
+            elif nodes[i][0] < nodes[min2][0]:
+                min2 = i
+        parent = (nodes[min1][0] + nodes[min2][0], (nodes[min1][1], nodes[min2][1]))
+        nodes[min1] = parent
+        nodes[min2] = nodes[-1]
+        nodes.pop()
+    return nodes[0][1] if nodes else None
+
+
+def _huffman_codes(node, prefix=0, depth=0, codes=None):
+    if codes is None:
+        codes = {}
+    if isinstance(node, int):
+        codes[node] = (prefix, depth)
+        return codes
+    _huffman_codes(node[0], prefix << 1, depth + 1, codes)
+    _huffman_codes(node[1], (prefix << 1) | 1, depth + 1, codes)
+    return codes
+
+
+def encode_huffman(data):
+    freq = [0] * 256
+    for b in data:
+        freq[b] += 1
+    codes = _huffman_codes(_huffman_tree(freq)) if data else {}
+
+    out = bytearray(struct.pack("<256I", *freq))
+    bit_buffer, bit_count = 0, 0
+    for b in data:
+        code, length = codes[b]
+        bit_buffer = (bit_buffer << length) | code
+        bit_count += length
+        while bit_count >= 8:
+            bit_count -= 8
+            out.append((bit_buffer >> bit_count) & 0xFF)
+        bit_buffer &= (1 << bit_count) - 1
+    if bit_count > 0:
+        out.append((bit_buffer << (8 - bit_count)) & 0xFF)
+    return bytes(out)
+
+
+def decode_huffman(payload):
+    freq = struct.unpack_from("<256I", payload)
+    total = sum(freq)
+    root = _huffman_tree(freq)
+    if root is None:
+        return b""
+    if isinstance(root, int):
+        return bytes((root,)) * total
+
+    # Table decode: every max_len-bit window maps straight to (symbol, code length)
+    codes = _huffman_codes(root)
+    max_len = max(length for _, length in codes.values())
+    table = [None] * (1 << max_len)
+    for sym, (code, length) in codes.items():
+        start = code << (max_len - length)
+        table[start:start + (1 << (max_len - length))] = [(sym, length)] * (1 << (max_len - length))
+
+    data = payload[256 * 4:]
+    bits = format(int.from_bytes(data, "big"), f"0{len(data) * 8}b") + "0" * max_len if data else ""
+    out = bytearray(total)
+    pos = 0
+    for i in range(total):
+        if pos >= len(bits) - max_len:
+            raise ValueError("Huffman payload ended before all symbols were decoded")
+        out[i], length = table[int(bits[pos:pos + max_len], 2)]
+        pos += length
+    return bytes(out)
+
+
+ENCODERS = {0x00: bytes, 0x03: encode_rle, 0x04: encode_huffman}
+DECODERS = {0x00: bytes, 0x03: decode_rle, 0x04: decode_huffman}
+
+
+def decode_block(codec, payload, raw_len, crc):
+    """Check and decode one block payload (runs in worker processes)."""
+    if zlib.crc32(payload) != crc:
+        raise ValueError("Block checksum mismatch")
+    raw = DECODERS[codec](payload)
+    if len(raw) != raw_len:
+        raise ValueError(f"Block decoded to {len(raw)} bytes, expected {raw_len}")
+    return raw
+
+
+def _unpack(fmt, data, what):
+    # Short reads surface as ValueError like every other format problem
+    try:
+        return fmt.unpack(data)
+    except struct.error:
+        raise ValueError(f"Truncated {what}") from None
+
+
+def _is_header(line):
+    try:
+        [float(field) for field in line.split(b",")]
+    except ValueError:
+        return True
+    return False
+
+
+# --- Container ---
+
+class PPGBlockContainer:
+    def __init__(self, path, sample_rate=None, block_rows=None, codec=None,
+                 workers=None, executor=None, parallel_min_bytes=1 << 20):
+        """Open an existing container, or create one when sample_rate is given.
+
+        Reads decode in a process pool only once the blocks they touch hold at
+        least parallel_min_bytes of raw CSV; smaller windows decode inline.
+        The pool is created on first use and reused until close(), or an
+        existing executor can be passed in (it is then left running).
+        """
+        self.path = path
+        self.index = []  # [(offset, first_sample, sample_count)]
+        self.workers = workers
+        self.parallel_min_bytes = parallel_min_bytes
+        self._executor = executor
+        self._owns_executor = executor is None
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self._load()
+            # Settings are fixed by the header; refuse to silently reinterpret the file
+            for name, given, stored in (("sample_rate", sample_rate, self.sample_rate),
+                                        ("block_rows", block_rows, self.block_rows),
+                                        ("codec", codec and codec.upper(), CODEC_NAMES[self.codec])):
+                if given is not None and given != stored:
+                    raise ValueError(f"{path} was created with {name}={stored}, not {given}")
+        elif sample_rate is None:
+            raise FileNotFoundError(f"{path} does not exist and no sample_rate was given")
+        else:
+            self.sample_rate = float(sample_rate)
+            self.block_rows = int(block_rows or 1024)
+            self.codec = CODECS[(codec or "HUFFMAN").upper()]
+            with open(path, "wb") as f:
+                f.write(FILE_HEADER.pack(FILE_MAGIC, VERSION, self.codec, self.sample_rate, self.block_rows))
+                self._write_index(f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._executor and self._owns_executor:
+            self._executor.shutdown()
+            self._executor = None
+
+    @property
+    def sample_count(self):
+        if not self.index:
+            return 0
+        _, first, count = self.index[-1]
+        return first + count
+
+    @property
+    def duration(self):
+        return self.sample_count / self.sample_rate
+
+    def _load(self):
+        with open(self.path, "rb") as f:
+            magic, version, self.codec, self.sample_rate, self.block_rows = _unpack(
+                FILE_HEADER, f.read(FILE_HEADER.size), "file header")
+            if magic != FILE_MAGIC or version != VERSION:
+                raise ValueError(f"{self.path} is not a version {VERSION} PPG container")
+
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size >= FILE_HEADER.size + TRAILER.size:
+                f.seek(size - TRAILER.size)
+                index_offset, block_count, table_crc, magic = TRAILER.unpack(f.read(TRAILER.size))
+                if magic == INDEX_MAGIC and index_offset + block_count * INDEX_ENTRY.size + TRAILER.size == size:
+                    f.seek(index_offset)
+                    table = f.read(block_count * INDEX_ENTRY.size)
+                    index = [INDEX_ENTRY.unpack_from(table, i * INDEX_ENTRY.size) for i in range(block_count)]
+                    if zlib.crc32(table) == table_crc and self._index_matches(f, index, index_offset):
+                        self.index = index
+                        self.data_end = index_offset
+                        return
+
+            # No valid offset table (e.g. interrupted append): rebuild it from the block headers
+            self.index, self.data_end = self._scan_blocks(f, size)
+
+    def _index_matches(self, f, index, index_offset):
+        expected_first = 0
+        for offset, first, count in index:
+            f.seek(offset)
+            header = f.read(BLOCK_HEADER.size)
+            if len(header) < BLOCK_HEADER.size:
+                return False
+            magic, _, block_first, block_count, _, payload_len, _ = BLOCK_HEADER.unpack(header)
+            if (magic != BLOCK_MAGIC or (block_first, block_count) != (first, count) or first != expected_first
+                    or offset + BLOCK_HEADER.size + payload_len > index_offset):
+                return False
+            expected_first = first + count
+        return True
+
+    def _scan_blocks(self, f, size):
+        index = []
+        offset = FILE_HEADER.size
+        while offset + BLOCK_HEADER.size <= size:
+            f.seek(offset)
+            magic, _, first, count, _, payload_len, crc = BLOCK_HEADER.unpack(f.read(BLOCK_HEADER.size))
+            end = offset + BLOCK_HEADER.size + payload_len
+            if magic != BLOCK_MAGIC or end > size or zlib.crc32(f.read(payload_len)) != crc:
+                break
+            # A rewritten partial tail supersedes the earlier copy of those samples
+            while index and index[-1][1] >= first:
+                index.pop()
+            index.append((offset, first, count))
+            offset = end
+        return index, offset
+
+    def _write_index(self, f):
+        self.data_end = f.tell()
+        table = b"".join(INDEX_ENTRY.pack(*entry) for entry in self.index)
+        f.write(table)
+        f.write(TRAILER.pack(self.data_end, len(self.index), zlib.crc32(table), INDEX_MAGIC))
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+
+    def _read_block(self, f, offset):
+        f.seek(offset)
+        magic, codec, first, count, raw_len, payload_len, crc = _unpack(
+            BLOCK_HEADER, f.read(BLOCK_HEADER.size), f"block header at offset {offset}")
+        if magic != BLOCK_MAGIC:
+            raise ValueError(f"Bad block header at offset {offset}")
+        return codec, f.read(payload_len), raw_len, crc
+
+    def append(self, rows):
+        """Append CSV rows (str or bytes, one sample each) as new blocks."""
+        checked = []
+        for row in rows:
+            row = row.encode() if isinstance(row, str) else bytes(row)
+            row = row[:-2] if row.endswith(b"\r\n") else row[:-1] if row.endswith(b"\n") else row
+            if b"\n" in row or b"\r" in row:
+                raise ValueError(f"Row contains a line break: {row!r}")
+            checked.append(row + b"\n")
+        rows = checked
+        if not rows:
+            return
+
+        with open(self.path, "r+b") as f:
+            # Re-encode a partial last block together with the new rows so blocks stay fixed-size.
+            # The merged block goes after the old one, which stays valid until the new index lands.
+            index = list(self.index)
+            if index and index[-1][2] < self.block_rows:
+                offset, _, _ = index.pop()
+                tail = decode_block(*self._read_block(f, offset))
+                rows = tail.splitlines(keepends=True) + rows
+            first = index[-1][1] + index[-1][2] if index else 0
+
+            f.seek(self.data_end)
+            for start in range(0, len(rows), self.block_rows):
+                raw = b"".join(rows[start:start + self.block_rows])
+                count = min(self.block_rows, len(rows) - start)
+                payload = ENCODERS[self.codec](raw)
+                index.append((f.tell(), first + start, count))
+                f.write(BLOCK_HEADER.pack(BLOCK_MAGIC, self.codec, first + start, count,
+                                          len(raw), len(payload), zlib.crc32(payload)))
+                f.write(payload)
+            # Blocks must be on disk before the table that points at them
+            f.flush()
+            os.fsync(f.fileno())
+            self.index = index
+            self._write_index(f)
+
+    def read_samples(self, start, stop):
+        """Return the CSV bytes for samples [start, stop)."""
+        start = max(0, start)
+        stop = min(stop, self.sample_count)
+        blocks = [entry for entry in self.index if entry[1] < stop and entry[1] + entry[2] > start]
+        if not blocks:
+            return b""
+
+        with open(self.path, "rb") as f:
+            jobs = [self._read_block(f, offset) for offset, _, _ in blocks]
+        raw_bytes = sum(raw_len for _, _, raw_len, _ in jobs)
+        if len(jobs) > 1 and self.workers != 1 and raw_bytes >= self.parallel_min_bytes:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            decoded = list(self._executor.map(decode_block, *zip(*jobs)))
+        else:
+            decoded = [decode_block(*job) for job in jobs]
+
+        out = []
+        for (_, first, _), raw in zip(blocks, decoded):
+            lines = raw.splitlines(keepends=True)
+            out.extend(lines[max(0, start - first):stop - first])
+        return b"".join(out)
+
+    def read_time_range(self, start_s, end_s):
+        """Return the CSV bytes recorded between start_s and end_s seconds."""
+        return self.read_samples(int(start_s * self.sample_rate), int(end_s * self.sample_rate))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack PPG CSV files into a block-indexed container, or read a window back.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    pack = sub.add_parser("pack", help="append a CSV file to a container")
+    pack.add_argument("container")
+    pack.add_argument("csv")
+    pack.add_argument("--sample-rate", type=float, help="required when creating a container")
+    pack.add_argument("--block-rows", type=int, help="rows per block for a new container (default 1024)")
+    pack.add_argument("--codec", choices=list(CODECS), help="codec for a new container (default HUFFMAN)")
+
+    read = sub.add_parser("read", help="print the samples between two times (seconds)")
+    read.add_argument("container")
+    read.add_argument("start", type=float)
+    read.add_argument("end", type=float)
+    read.add_argument("--workers", type=int, default=None)
+
+    args = parser.parse_args()
+    try:
+        if args.command == "pack":
+            container = PPGBlockContainer(args.container, args.sample_rate, args.block_rows, args.codec)
+            with open(args.csv, "rb") as f:
+                lines = [line for line in f.read().splitlines() if line.strip()]
+            # Column headers (PPG exports, ina228_*.csv) are not samples
+            if lines and _is_header(lines[0]):
+                lines = lines[1:]
+            container.append(lines)
+            print(f"{args.container}: {container.sample_count} samples in {len(container.index)} blocks")
+        else:
+            with PPGBlockContainer(args.container, workers=args.workers) as container:
+                print(container.read_time_range(args.start, args.end).decode(), end="")
+    except (FileNotFoundError, ValueError) as e:
+        parser.error(str(e))
+
+
+if __name__ == "__main__":
+    main()